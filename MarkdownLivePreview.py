@@ -13,19 +13,31 @@ from functools import partial
 import sublime
 import sublime_plugin
 
-from .markdown2html import markdown2html
+from .markdown2html import hash_markdown, markdown2html, markdowner
 
 PREVIEW_VIEW_INFO = "preview_view_info"
 resources = {}
+is_markdown_cache = {}  # {view.id(): bool}, see is_markdown
 
 
 def find_preview(view):
     """find previews for input view."""
+    for preview_id in MarkdownLivePreviewListener.preview_map.get(view.id(), ()):
+        preview = sublime.View(preview_id)
+        # the buffer id is 0 once the view is closed
+        if preview.buffer_id() != 0:
+            yield preview
+
+
+def is_markdown(view):
+    """on_modified is called on every keystroke of every view, so whether a
+    view is markdown is cached until its syntax might have changed (see
+    MarkdownLivePreviewListener.invalidate_is_markdown)
+    """
     view_id = view.id()
-    for x in view.window().views():
-        d = x.settings().get(PREVIEW_VIEW_INFO)
-        if d and d.get("id") == view_id:
-            yield x
+    if view_id not in is_markdown_cache:
+        is_markdown_cache[view_id] = "markdown" in view.settings().get("syntax").lower()
+    return is_markdown_cache[view_id]
 
 
 def get_resource(resource):
@@ -40,49 +52,96 @@ def get_resource(resource):
 class MarkdownLivePreviewListener(sublime_plugin.EventListener):
     last_update = 0  # update only if now() - last_update > DELAY
     phantom_sets = {}  # {preview.id(): PhantomSet}
+    pending_renders = set()  # {markdown_view.id()}, see schedule_re_render
+    last_hashes = {}  # {preview.id(): (hash of the markdown, viewport width)}
+    preview_map = {}  # {markdown_view.id(): [preview.id()]}
+    last_htmls = {}  # {preview.id(): html}, to only update phantoms that changed
 
     def on_pre_close(self, view):
         """Closing markdown files closes any associated previews."""
-        if "markdown" in view.settings().get("syntax").lower():
+        if is_markdown(view):
             previews = list(find_preview(view))
             if previews:
                 window = view.window()
                 for preview in previews:
                     window.focus_view(preview)
                     window.run_command("close_file")
+            self.preview_map.pop(view.id(), None)
         else:
             d = view.settings().get(PREVIEW_VIEW_INFO)
             if d:
                 view_id = view.id()
                 if view_id in self.phantom_sets:
                     del self.phantom_sets[view_id]
+                self.last_hashes.pop(view_id, None)
+                self.last_htmls.pop(view_id, None)
+                preview_ids = self.preview_map.get(d["id"], [])
+                if view_id in preview_ids:
+                    preview_ids.remove(view_id)
+
+    def invalidate_is_markdown(self, view):
+        is_markdown_cache.pop(view.id(), None)
+
+    on_load_async = on_activated_async = on_post_save_async = on_close = invalidate_is_markdown
+
+    def on_post_text_command(self, view, command_name, args):
+        # changing the syntax doesn't trigger any of the events above
+        if command_name == "set_file_type":
+            self.invalidate_is_markdown(view)
 
     def on_modified_async(self, view):
         """Schedule an update when changing markdown files"""
-        if "markdown" in view.settings().get("syntax").lower():
+        if is_markdown(view):
             sublime.set_timeout(partial(self.update_preview, view), DELAY)
 
-    def update_preview(self, view):
+    def schedule_re_render(self, view):
+        """Called every time a remote image finishes loading. When a lot of
+        images load at the same time, only render once for all of them.
+        """
+        if view.id() in self.pending_renders:
+            return
+        self.pending_renders.add(view.id())
+        sublime.set_timeout(partial(self.update_preview, view, True), DELAY)
+
+    def update_preview(self, view, force=False):
+        """Renders the markdown in its previews. Unless force is True, previews
+        which were last rendered from the same markdown aren't updated.
+        """
+        self.pending_renders.discard(view.id())
         # if the buffer id is 0, that means that the markdown_view has been
         # closed. This check is needed since a this function is used as a
         # callback for when images are loaded from the internet (ie. it could
         # finish loading *after* the user closes the markdown_view)
-        if time.time() - self.last_update < DELAY / 1000:
-            return
         if view.buffer_id() == 0:
             return
+        if time.time() - self.last_update < DELAY / 1000:
+            # an image finished loading, it mustn't be missed
+            if force:
+                self.schedule_re_render(view)
+            return
         previews = list(find_preview(view))
         if not previews:
             return
-        self.last_update = time.time()
+        markdown = view.substr(sublime.Region(0, view.size()))
+        digest = hash_markdown(markdown)
         for preview in previews:
+            viewport_width = preview.viewport_extent()[0]
+            if not force and self.last_hashes.get(preview.id()) == (digest, viewport_width):
+                continue
+            self.last_hashes[preview.id()] = digest, viewport_width
+            self.last_update = time.time()
+
             html = markdown2html(
-                view.substr(sublime.Region(0, view.size())),
+                markdown,
                 os.path.dirname(view.file_name()),
-                partial(self.update_preview, view),
+                partial(self.schedule_re_render, view),
                 resources,
-                preview.viewport_extent()[0],
+                viewport_width,
+                digest,
             )
+            if self.last_htmls.get(preview.id()) == html:
+                continue
+            self.last_htmls[preview.id()] = html
             self.phantom_sets[preview.id()].update(
                 [sublime.Phantom(sublime.Region(0), html, sublime.LAYOUT_BLOCK, lambda x: sublime.run_command("open_url", {"url": x}))]
             )
@@ -101,11 +160,12 @@ class OpenMarkdownPreviewCommand(sublime_plugin.TextCommand):
         view.settings().set(PREVIEW_VIEW_INFO, {"id": self.view.id()})
         ps = MarkdownLivePreviewListener.phantom_sets
         ps[view.id()] = sublime.PhantomSet(view)
+        MarkdownLivePreviewListener.preview_map.setdefault(self.view.id(), []).append(view.id())
         MarkdownLivePreviewListener().update_preview(self.view)
         window.focus_view(self.view)
 
     def is_enabled(self):
-        return "markdown" in self.view.settings().get("syntax").lower()
+        return is_markdown(self.view)
 
 
 def parse_image_resource(text):
@@ -119,3 +179,8 @@ def plugin_loaded():
     resources["base64_404_image"] = parse_image_resource(get_resource("404.base64"))
     resources["base64_loading_image"] = parse_image_resource(get_resource("loading.base64"))
     resources["stylesheet"] = get_resource("stylesheet.css")
+    resources["style_prefix"] = "<style>\n{}\n</style>\n\n".format(resources["stylesheet"])
+    resources["cache_dir"] = os.path.join(sublime.cache_path(), "MarkdownLivePreview")
+    # markdown2 compiles most of its regexes on the first conversion, do it now
+    # rather than on the first keystroke
+    markdowner.convert("# warmup\n")
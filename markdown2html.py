@@ -1,28 +1,107 @@
 import base64
+import hashlib
 import io
+import json
 import os.path
+import re
 import struct
 import urllib.request
+from collections import OrderedDict
 from functools import partial
+from html import escape
 
 import bs4
 import concurrent.futures
 
 from .lib.markdown2 import Markdown
 
+REMOTE_PREFIXES = ("http://", "https://")
+BASE64_PREFIX = b"data:image/png;base64,"
+
+# ST3 collapses whitespace in <pre>, so we show it explicitly
+PRE_WHITESPACE = re.compile(r"[ \n]")
+PRE_WHITESPACE_REPLACEMENTS = {" ": '<i class="space">.</i>', "\n": "<br />"}
+PRE_PLACEHOLDER = re.compile("\x00(\\d+)\x00")
+
 markdowner = Markdown(extras=["code-friendly", "fenced-code-blocks", "cuddled-lists"])
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+# downloading images is I/O bound, so the threads spend most of their time
+# waiting on the network
+MAX_DOWNLOAD_WORKERS = 16
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS)
+
+# each entry is the whole document, images included, so only keep a few (the
+# last renders of the open previews)
+HTML_CACHE_SIZE = 4
+# {(digest, basepath, viewport_width, images_generation): html}, oldest first.
+# See markdown2html
+html_cache = OrderedDict()
+# bumped every time an image finishes loading, so that the html which was
+# generated while it was loading isn't reused
+images_generation = 0
+
+MARKDOWN_CACHE_SIZE = 64
+# {digest: html}, oldest first. Re-renders triggered by images
+# finishing to load don't need to parse the markdown again
+markdown_cache = OrderedDict()
+
+
+def markdown2html_cache_clear():
+    html_cache.clear()
+    markdown_cache.clear()
+
+
+def hash_markdown(markdown):
+    return hashlib.sha256(markdown.encode("utf-8")).digest()
 
 
-def markdown2html(markdown, basepath, re_render, resources, viewport_width):
+def convert_markdown(markdown, digest):
+    """digest is hash_markdown(markdown)"""
+    if digest in markdown_cache:
+        return markdown_cache[digest]
+
+    html = markdowner.convert(markdown)
+
+    markdown_cache[digest] = html
+    if len(markdown_cache) > MARKDOWN_CACHE_SIZE:
+        markdown_cache.popitem(last=False)
+    return html
+
+
+def markdown2html(markdown, basepath, re_render, resources, viewport_width, digest=None):
     """converts the markdown to html.
 
     Loads the images and puts in base64 for sublime to understand them
     correctly. That means that we are responsible for loading the images from
     the internet. Hence, we take in re_render, which is just a function we call
     when an image has finished loading to retrigger a render (see #90)
+
+    The result is cached, so rendering the same markdown twice is cheap.
+    digest is hash_markdown(markdown), pass it if it's already computed.
     """
-    html = markdowner.convert(markdown)
+    if digest is None:
+        digest = hash_markdown(markdown)
+
+    key = digest, basepath, viewport_width, images_generation
+    if key in html_cache:
+        return html_cache[key]
+
+    html = _markdown2html(markdown, digest, basepath, re_render, resources, viewport_width)
+
+    html_cache[key] = html
+    if len(html_cache) > HTML_CACHE_SIZE:
+        html_cache.popitem(last=False)
+    return html
+
+
+def _markdown2html(markdown, digest, basepath, re_render, resources, viewport_width):
+    html = convert_markdown(markdown, digest)
+
+    # building the tree is the slow part. Besides fixing up images and pre
+    # blocks, it repairs raw html and decodes entities, so it can only be
+    # skipped when the markdown has neither, and markdown2 didn't generate any
+    # images or pre blocks.
+    if "<" not in markdown and "&" not in markdown and "<img" not in html and "<pre" not in html:
+        return resources["style_prefix"] + html.replace("<br/>", "<br />")
 
     soup = bs4.BeautifulSoup(html, "html.parser")
     for img_element in soup.find_all("img"):
@@ -30,18 +109,19 @@ def markdown2html(markdown, basepath, re_render, resources, viewport_width):
 
         # already in base64, or something of the like
         if src.startswith("data:image/"):
-            continue
-
-        if src.startswith("http://") or src.startswith("https://"):
-            path = src
-        elif src.startswith("file://"):
-            path = src[len("file://") :]
+            width, height = get_data_uri_size(src)
         else:
-            path = os.path.realpath(os.path.expanduser(os.path.join(basepath, src)))
+            is_remote = src.startswith(REMOTE_PREFIXES)
+            if is_remote:
+                path = src
+            elif src.startswith("file://"):
+                path = src[len("file://") :]
+            else:
+                path = os.path.realpath(os.path.expanduser(os.path.join(basepath, src)))
 
-        base64, (width, height) = get_base64_image(path, re_render, resources)
+            base64, (width, height) = get_base64_image(path, is_remote, re_render, resources)
+            img_element["src"] = base64
 
-        img_element["src"] = base64
         if width > viewport_width:
             img_element["width"] = viewport_width
             img_element["height"] = viewport_width * (height / width)
@@ -49,23 +129,65 @@ def markdown2html(markdown, basepath, re_render, resources, viewport_width):
     # remove comments, because they pollute the console with error messages
     [x.extract() for x in soup.find_all(text=lambda text: isinstance(text, bs4.Comment))]
 
-    # pre aren't handled by ST3 and require manual adjustment
+    # pre aren't handled by ST3 and require manual adjustment. Instead of
+    # parsing the adjusted code again, each piece of text is swapped for a
+    # placeholder which is replaced once the soup is serialized. Tags inside
+    # the code (eg. highlighting) are left as they are.
+    fixed_code = []
     for pre_element in soup.find_all("pre"):
         # select the first child, <code>
-        code_element = next(pre_element.children)
-        fixed_pre = str(code_element).replace(" ", '<i class="space">.</i>').replace("\n", "<br />")
-        code_element.replace_with(bs4.BeautifulSoup(fixed_pre, "html.parser"))
+        code_element = next(pre_element.children, None)
+        if code_element is None:
+            continue
+
+        if isinstance(code_element, bs4.Tag):
+            strings = code_element.find_all(text=True)
+        else:
+            strings = [code_element]
+
+        for string in strings:
+            fixed_code.append(fix_pre_whitespace(string))
+            string.replace_with(bs4.NavigableString("\x00{}\x00".format(len(fixed_code) - 1)))
+
+    body = str(soup)
+
+    if fixed_code:
+        body = PRE_PLACEHOLDER.sub(lambda match: fixed_code[int(match.group(1))], body)
 
     # FIXME:
     # - report that ST doesn't support <br/> but does work with <br />... WTF?
-    return "<style>\n{}\n</style>\n\n{}".format(resources["stylesheet"], soup).replace("<br/>", "<br />")
+    return resources["style_prefix"] + body.replace("<br/>", "<br />")
+
+
+def fix_pre_whitespace(text):
+    return PRE_WHITESPACE.sub(lambda match: PRE_WHITESPACE_REPLACEMENTS[match.group()], escape(text, quote=False))
 
 
 images_cache = {}
-images_loading = []
+images_loading = set()
+data_uri_sizes = {}  # {hash(src): (width, height)}
 
 
-def get_base64_image(path, re_render, resources):
+def get_data_uri_size(src):
+    """Gets the size of an image which is already in a data uri.
+
+    Only the beginning of the data is decoded, which is enough for png and
+    gif headers. Returns (0, 0) if the size couldn't be found.
+    """
+    key = hash(src)
+    if key not in data_uri_sizes:
+        header, _, data = src.partition(",")
+        size = 0, 0
+        if header.endswith(";base64"):
+            try:
+                size = get_image_size(io.BytesIO(base64.b64decode(data[:64])), header)
+            except ValueError:
+                pass
+        data_uri_sizes[key] = size
+    return data_uri_sizes[key]
+
+
+def get_base64_image(path, is_remote, re_render, resources):
     """Gets the base64 for the image (local and remote images).
 
     re_render is a callback which is called when we finish loading an image
@@ -82,44 +204,197 @@ def get_base64_image(path, re_render, resources):
         > always called in a thread belonging to the process that added them
         (Python docs)
         """
+        global images_generation
+
+        # when checking an image from the disk cache (ie. it's already in
+        # images_cache), only drop it if it's really gone, not because of a
+        # transient error (rate limit, offline, captive portal, ...)
         try:
-            images_cache[path] = future.result()
+            image = future.result()
         except urllib.error.HTTPError as e:
-            images_cache[path] = resources["base64_404_image"]
             print("Error loading {!r}: {!r}".format(path, e))
+            if e.code in (404, 410):
+                remove_disk_cache(resources["cache_dir"], path)
+                image = resources["base64_404_image"]
+            elif path in images_cache:
+                image = None
+            else:
+                image = resources["base64_404_image"]
+        except (OSError, ValueError) as e:
+            print("Error loading {!r}: {!r}".format(path, e))
+            if path in images_cache:
+                image = None
+            else:
+                image = resources["base64_404_image"]
+        finally:
+            images_loading.discard(path)
+
+        # the image from the disk cache is kept
+        if image is None:
+            return
 
-        images_loading.remove(path)
+        images_cache[path] = image
+        images_generation += 1
 
         # we render, which means this function will be called again, but this
         # time, we will read from the cache
         re_render()
 
-    if path in images_cache:
-        return images_cache[path]
+    image = images_cache.get(path)
+    if image is not None:
+        return image
+
+    if is_remote:
+        if path in images_loading:
+            return resources["base64_loading_image"]
+
+        cached = read_disk_cache(resources["cache_dir"], path)
+        if cached is None:
+            metadata = None
+        else:
+            image, metadata = cached
+            images_cache[path] = image
+
+        # if it was on disk, this just checks that it hasn't changed since
+        executor.submit(load_image, path, resources["cache_dir"], metadata).add_done_callback(
+            partial(callback, path, resources)
+        )
+        images_loading.add(path)
 
-    if path.startswith("http://") or path.startswith("https://"):
-        if path not in images_loading:
-            executor.submit(load_image, path).add_done_callback(partial(callback, path, resources))
-            images_loading.append(path)
-        return resources["base64_loading_image"]
+        if cached is None:
+            return resources["base64_loading_image"]
+        return images_cache[path]
 
     with open(path, "rb") as fhandle:
         image_content = fhandle.read()
         width, height = get_image_size(io.BytesIO(image_content), path)
-        image = "data:image/png;base64," + base64.b64encode(image_content).decode("utf-8")
+        image = (BASE64_PREFIX + base64.b64encode(image_content)).decode("ascii")
         images_cache[path] = image, (width, height)
         return images_cache[path]
 
 
-def load_image(url):
-    with urllib.request.urlopen(url, timeout=60) as conn:
-        image_content = conn.read()
-        width, height = get_image_size(io.BytesIO(image_content), url)
+# a multiple of 3, so that base64 encoding each chunk separately gives the
+# same result as encoding the whole image at once
+DOWNLOAD_CHUNK_SIZE = 48 * 1024
+# how much of a jpeg to look through for its size (metadata can come first)
+# before giving up
+MAX_IMAGE_HEAD_SIZE = 256 * 1024
+
+
+def load_image(url, cache_dir, metadata=None):
+    """Downloads the image by chunks, encoding each one as it comes, so that
+    the whole raw image is never held in memory alongside its base64.
+
+    metadata is the metadata of the image from the disk cache, if any. If the
+    server says that the image hasn't changed since, None is returned.
+    """
+    request = urllib.request.Request(url)
+    if metadata is not None:
+        if metadata.get("etag"):
+            request.add_header("If-None-Match", metadata["etag"])
+        if metadata.get("last_modified"):
+            request.add_header("If-Modified-Since", metadata["last_modified"])
+
+    try:
+        conn = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+    with conn:
         content_type = conn.info().get_content_type()
         if "image" not in content_type:
             raise ValueError("{!r} doesn't point to an image, but to a {!r}".format(url, content_type))
-        image_content = base64.b64encode(image_content).decode("utf-8")
-        return "data:image/png;base64," + image_content, (width, height)
+
+        width, height = 0, 0
+        # the beginning of the image, until we know its size
+        head = bytearray()
+        # bytes which haven't been encoded yet
+        pending = bytearray()
+        encoded = [BASE64_PREFIX]
+        while True:
+            chunk = conn.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            if head is not None:
+                head += chunk
+                width, height = get_image_size(io.BytesIO(head), url)
+                # only jpegs might need more than the first chunk
+                if (
+                    (width, height) != (0, 0)
+                    or not head.startswith(b"\xff\xd8")
+                    or len(head) >= MAX_IMAGE_HEAD_SIZE
+                ):
+                    head = None
+
+            pending += chunk
+            end = len(pending) - len(pending) % 3
+            encoded.append(base64.b64encode(pending[:end]))
+            del pending[:end]
+        encoded.append(base64.b64encode(pending))
+
+        image = b"".join(encoded).decode("ascii"), (width, height)
+        metadata = {"etag": conn.headers.get("ETag"), "last_modified": conn.headers.get("Last-Modified")}
+        write_disk_cache(cache_dir, url, image, metadata)
+        return image
+
+
+def get_disk_cache_paths(cache_dir, url):
+    """return base64_path, metadata_path"""
+    name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, name + ".b64"), os.path.join(cache_dir, name + ".meta.json")
+
+
+def read_disk_cache(cache_dir, url):
+    """return (base64_data, (width, height)), metadata
+
+    or None if the image isn't cached on disk
+    """
+    base64_path, metadata_path = get_disk_cache_paths(cache_dir, url)
+    try:
+        with open(base64_path, "r") as fp:
+            image = fp.read()
+        with open(metadata_path, "r") as fp:
+            metadata = json.load(fp)
+        return (image, (metadata["width"], metadata["height"])), metadata
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_disk_cache(cache_dir, url, image, metadata):
+    base64_data, (width, height) = image
+    metadata = dict(metadata, width=width, height=height)
+    base64_path, metadata_path = get_disk_cache_paths(cache_dir, url)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # the image isn't read back without its metadata, so remove the old
+        # metadata first: it must never end up next to the new image
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+        replace_file(base64_path, base64_data)
+        replace_file(metadata_path, json.dumps(metadata))
+    except OSError as e:
+        print("Error caching {!r}: {!r}".format(url, e))
+
+
+def remove_disk_cache(cache_dir, url):
+    for path in get_disk_cache_paths(cache_dir, url):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def replace_file(path, content):
+    """Writes to a temporary file which then replaces path, so that path is
+    never left half written
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        fp.write(content)
+    os.replace(tmp_path, path)
 
 
 def get_image_size(fhandle, pathlike):
@@ -129,44 +404,47 @@ def get_image_size(fhandle, pathlike):
     streams, but in our case, we have to load the whole stream into memory
     anyway because base64 library only accepts bytes-like objects, and not
     streams.
-    pathlike is the filename/path/url of the image so that we can guess the
-    file format
-    """
+    pathlike is the filename/path/url of the image, only used to report
+    errors. The format is guessed from the first bytes of the image, so that
+    urls without an extension work too.
 
-    format_ = os.path.splitext(os.path.basename(pathlike))[1][1:]
+    Returns (0, 0) if the size couldn't be found.
+    """
 
     head = fhandle.read(24)
-    if len(head) != 24:
-        return "invalid head"
-    if format_ == "png":
-        check = struct.unpack(">i", head[4:8])[0]
-        if check != 0x0D0A1A0A:
-            return
-        width, height = struct.unpack(">ii", head[16:24])
-    elif format_ == "gif":
-        width, height = struct.unpack("<HH", head[6:10])
-    elif format_ == "jpeg":
-        try:
-            fhandle.seek(0)  # Read 0xff next
-
-            size = 2
-            ftype = 0
-            while not 0xC0 <= ftype <= 0xCF:
-                fhandle.seek(size, 1)
-                byte = fhandle.read(1)
-                if byte == b"":
-                    fhandle = end  # noqa
-                    byte = fhandle.read(1)
-
-                while ord(byte) == 0xFF:
-                    byte = fhandle.read(1)
-                ftype = ord(byte)
-                size = struct.unpack(">H", fhandle.read(2))[0] - 2
-            # We are at a SOFn block
-            fhandle.seek(1, 1)  # Skip `precision' byte.
-            height, width = struct.unpack(">HH", fhandle.read(4))
-        except Exception as e:  # IGNORE:W0703
-            raise e
-    else:
-        return "unknown format {!r}".format(format_)
+    try:
+        if head.startswith(b"\x89PNG\r\n\x1a\n"):
+            width, height = struct.unpack(">ii", head[16:24])
+        elif head[:6] in (b"GIF87a", b"GIF89a"):
+            width, height = struct.unpack("<HH", head[6:10])
+        elif head.startswith(b"\xff\xd8"):
+            width, height = get_jpeg_size(fhandle)
+        else:
+            print("Unknown image format for {!r}".format(pathlike))
+            return 0, 0
+    except struct.error:
+        # the image is truncated
+        return 0, 0
     return width, height
+
+
+def get_jpeg_size(fhandle):
+    """Walks the jpeg segments up to the first SOFn one, which contains the
+    size of the image. Raises struct.error if the image is truncated.
+    """
+    fhandle.seek(2)  # skip SOI
+    while True:
+        byte = fhandle.read(1)
+        # markers can be padded with any number of 0xFF
+        while byte == b"\xff":
+            byte = fhandle.read(1)
+        if byte == b"":
+            raise struct.error("no SOFn marker found")
+        ftype = ord(byte)
+        # DHT, JPG and DAC are in the SOFn range, but aren't frames
+        if 0xC0 <= ftype <= 0xCF and ftype not in (0xC4, 0xC8, 0xCC):
+            fhandle.seek(3, 1)  # skip the length and the precision
+            height, width = struct.unpack(">HH", fhandle.read(4))
+            return width, height
+        size = struct.unpack(">H", fhandle.read(2))[0]
+        fhandle.seek(size - 2, 1)